@@ -29,6 +29,9 @@ setup(
         "kedro-viz==3.14.0",
         "SQLAlchemy==1.4.23",
         "SQLAlchemy-Utils==0.37.8",
+        "psycopg2-binary==2.9.1",
+        "orjson==3.6.4",
+        "xxhash==2.0.2",
         "pandas==1.3.3",
         "scikit-learn~=0.24.1"
     ],
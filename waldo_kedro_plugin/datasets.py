@@ -1,16 +1,108 @@
 """
 Custom Kedro Datasets
 """
+import math
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, closing
+from functools import lru_cache
+from itertools import islice
 from pathlib import PurePosixPath
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
 
 from kedro.config import ConfigLoader
 from kedro.extras.datasets.pandas import SQLTableDataSet
+from kedro.io.core import DataSetError
+import numpy as np
 import pandas as pd
+from psycopg2.extras import execute_values
 import sqlalchemy
 from .models import OutlierScore, Contexts
-from .utilities import insert_context, get_session, Engine, partition_indexes
+from .utilities import insert_context, get_session, get_engine, iter_partition_indexes, IterStream
 import logging
-from io import StringIO
+
+_CONF_PATH = "conf/base"
+# rows fetched per round-trip from the server-side cursor in '_load'
+_LOAD_CHUNKSIZE = 100000
+_LOAD_STMT = sqlalchemy.select(Contexts, OutlierScore).join_from(Contexts, OutlierScore)
+_SCORE_INDEX = next(index for index in OutlierScore.__table__.indexes if index.name == "idx_os_score")
+# IF [NOT] EXISTS makes the statements safe for saves running at the same time, unlike checking for the index first
+_DROP_SCORE_INDEX = sqlalchemy.text(f"DROP INDEX IF EXISTS {_SCORE_INDEX.name}")
+_CREATE_SCORE_INDEX = sqlalchemy.text(
+    f"CREATE INDEX IF NOT EXISTS {_SCORE_INDEX.name} ON {OutlierScore.__tablename__} "
+    f"({','.join(column.name for column in _SCORE_INDEX.columns)})"
+)
+
+# Specifying the columns, to make sure that the order of the encoded fields and the db is the same
+_COPY_COLUMNS = ("sample_id", "score", "prediction", "context_id")
+_COPY_STMT = f"COPY {OutlierScore.__tablename__} ({','.join(_COPY_COLUMNS)}) FROM STDIN WITH (FORMAT BINARY)"
+# Binary representation of the column types BIGINT, FLOAT, BOOLEAN and INT
+_COPY_TYPES = {"sample_id": ">i8", "score": ">f8", "prediction": "?", "context_id": ">i4"}
+# Signature, flags field and header extension length of the PostgreSQL binary COPY format
+_COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+_COPY_TRAILER = struct.pack(">h", -1)
+# One binary COPY tuple: field count followed by (length, value) pairs in column order, all in network byte order
+_COPY_ROW = np.dtype(
+    [("fields", ">i2")]
+    + [field for column in _COPY_COLUMNS for field in ((f"{column}_length", ">i4"), (column, _COPY_TYPES[column]))]
+)
+
+
+def _binary_copy(df: pd.DataFrame) -> Iterator[bytes]:
+    """
+    Encode the outlier score rows in the PostgreSQL binary COPY format, straight from the numpy columns.
+    Binary COPY does not cast, so float32 scores are widened to the 8 byte ``FLOAT`` of the column here.
+    :param df: dataframe with sample_id, score, prediction and context_id columns
+    :return: iterator over the encoded header, rows and trailer
+    """
+    rows = np.empty(len(df.index), dtype=_COPY_ROW)
+    rows["fields"] = len(_COPY_COLUMNS)
+    for column in _COPY_COLUMNS:
+        rows[f"{column}_length"] = _COPY_ROW.fields[column][0].itemsize
+        rows[column] = df[column].to_numpy()
+
+    yield _COPY_HEADER
+    yield rows.tobytes()
+    yield _COPY_TRAILER
+
+
+@lru_cache(maxsize=1)
+def _postgres_credentials() -> Dict[str, Any]:
+    """
+    Read the postgres credentials of the kedro project once and reuse them for every dataset instance.
+    :return: postgres credentials
+    """
+    return ConfigLoader([_CONF_PATH]).get("credentials*")["postgres"]
+
+
+def _execute_ddl(statement) -> None:
+    """
+    Execute a DDL statement in a transaction of its own.
+    :param statement: DDL statement
+    :return: None
+    """
+    with get_engine().begin() as conn:
+        conn.execute(statement)
+
+
+def _insert_values(table, conn, keys, data_iter) -> None:
+    """
+    Insertion method for ``DataFrame.to_sql``, which sends each chunk with psycopg2's ``execute_values``
+    instead of building one giant multi-row VALUES statement.
+    :param table: pandas SQLTable to insert into
+    :param conn: sqlalchemy connection
+    :param keys: column names
+    :param data_iter: iterable of row tuples
+    :return: None
+    """
+    name = f"{table.schema}.{table.name}" if table.schema else table.name
+    with conn.connection.cursor() as cursor:
+        execute_values(
+            cursor,
+            f"INSERT INTO {name} ({','.join(keys)}) VALUES %s",
+            list(data_iter),
+            page_size=1000,
+        )
 
 
 class OutlierScoreDataSet(SQLTableDataSet):
@@ -19,24 +111,38 @@ class OutlierScoreDataSet(SQLTableDataSet):
     dataframe to Waldo 'outlier_score' PostgreSQL table. It handles the joining between the 'context' and
     the 'outlier_score' tables internally inside both '_load' and '_save' methods. For '_save' it has two modes
     of operation for batch insertion to the database, based on the selected value for the 'use_copy' argument.
-    If 'use_copy' is False, it uses the '_save' implementation of parent SQLTableDataSet for the table insertion.
-    If 'use_copy' is True, it uses the 'copy_from' implementation of psycopg2 for the table insertion.
+    If 'use_copy' is False, it uses the '_save' implementation of parent SQLTableDataSet for the table insertion,
+    sending the rows with psycopg2's 'execute_values'.
+    If 'use_copy' is True, it streams the rows into a PostgreSQL binary COPY using psycopg2's 'copy_expert'.
+    The 'chunksize' in the save args only applies to the INSERTs, COPY batches use 'copy_chunksize' rows.
+    By default all COPY batches are sent over one connection, in a single transaction. With 'copy_workers' above 1
+    they are spread over that many connections, whose transactions are committed one after another once all of them
+    succeeded. A failing commit can then leave the batches of the connections committed before it stored.
+    With 'rebuild_index' the score index is dropped before and rebuilt in bulk after the insertion, which pays off
+    for batches that are large compared to the rows already in the table.
     """
 
-    def __init__(self, use_copy: bool = False) -> None:
+    def __init__(
+        self,
+        use_copy: bool = False,
+        copy_chunksize: int = 200000,
+        rebuild_index: bool = False,
+        copy_workers: int = 1,
+    ) -> None:
         self._table_name = OutlierScore.__tablename__
         self._save_args = {
             "if_exists": "append",
             "index": False,
             "schema": "public",
-            "method": "multi",
+            "method": _insert_values,
             "chunksize": 10000,
         }
-        conf_paths = ["conf/base"]
-        conf_loader = ConfigLoader(conf_paths)
-        credentials = conf_loader.get("credentials*")["postgres"]
+        credentials = _postgres_credentials()
         self._use_copy = use_copy
-        self._conf_paths = PurePosixPath(conf_paths[0])
+        self._copy_chunksize = copy_chunksize
+        self._rebuild_index = rebuild_index
+        self._copy_workers = max(1, copy_workers)
+        self._conf_paths = PurePosixPath(_CONF_PATH)
 
         super().__init__(
             table_name=self._table_name,
@@ -50,14 +156,21 @@ class OutlierScoreDataSet(SQLTableDataSet):
             save_args=self._save_args,
             conf_paths=self._conf_paths,
             use_copy=self._use_copy,
+            copy_chunksize=self._copy_chunksize,
+            rebuild_index=self._rebuild_index,
+            copy_workers=self._copy_workers,
         )
 
     def _load(self) -> pd.DataFrame:
-        stmt = sqlalchemy.select(Contexts, OutlierScore).join_from(
-            Contexts, OutlierScore
-        )
         try:
-            result_df = pd.read_sql(stmt, self._load_args["con"])
+            # a server-side cursor streams the rows, so only one chunk of raw rows is held next to the dataframe
+            with get_engine().connect() as conn:
+                chunks = pd.read_sql(
+                    _LOAD_STMT,
+                    conn.execution_options(stream_results=True),
+                    chunksize=_LOAD_CHUNKSIZE,
+                )
+                result_df = pd.concat(chunks, ignore_index=True)
             return result_df
         except (sqlalchemy.exc.SQLAlchemyError, ValueError) as err:
             logging.error(err)
@@ -65,50 +178,80 @@ class OutlierScoreDataSet(SQLTableDataSet):
 
     def _save(self, data: pd.DataFrame) -> None:
         with get_session() as session:
-            first = data.loc[0]
             new_context: Contexts = insert_context(
                 session,
-                first.at["run_id"],
-                first.at["algorithm"],
-                first.at["parameters"],
+                data["run_id"].iat[0],
+                data["algorithm"].iat[0],
+                data["parameters"].iat[0],
             )
 
-            data["context_id"] = new_context.id
-            data.drop(["run_id", "algorithm", "parameters"], axis=1, inplace=True)
+            # only the outlier_score columns are kept in COPY order, the context columns become the new context id
+            context_id = np.full(len(data.index), new_context.id, dtype=np.int32)
+            scores = pd.DataFrame(
+                {
+                    column: context_id if column == "context_id" else data[column].to_numpy()
+                    for column in _COPY_COLUMNS
+                }
+            )
 
-        if not self._use_copy:
-            super()._save(data)
-        else:
-            pyscopg2_conn = Engine.raw_connection()
-            self._copy_from_stringio(pyscopg2_conn, data)
+        if self._rebuild_index:
+            _execute_ddl(_DROP_SCORE_INDEX)
+        try:
+            if not self._use_copy:
+                super()._save(scores)
+            else:
+                self._copy_from_stream(scores)
+        except Exception:
+            if self._rebuild_index:
+                try:
+                    _execute_ddl(_CREATE_SCORE_INDEX)
+                except sqlalchemy.exc.SQLAlchemyError as err:
+                    # the error of the insertion is the one raised, a failing re-create must not replace it
+                    logging.error(err)
+            raise
+        if self._rebuild_index:
+            _execute_ddl(_CREATE_SCORE_INDEX)
 
-    def _copy_from_stringio(self, conn, df):
+    def _copy_from_stream(self, df):
         """
-        Here we are going save the dataframe in memory
-        and use copy_from() to copy it to the table
+        Here we are going to encode the dataframe in the binary COPY format
+        and stream it into copy_expert(), so no values are formatted or parsed as text.
+        The chunks are distributed round-robin over the worker connections, libpq releases the GIL during the I/O.
+        Only a single worker connection copies all chunks atomically.
         """
-        cursor = conn.cursor()
-        for value in partition_indexes(len(df.index), self._save_args["chunksize"]):
-            # save dataframe to an in memory buffer
-            buffer = StringIO()
-            df.iloc[value[0] : value[1]].to_csv(
-                buffer, index=self._save_args["index"], header=False
-            )
-            buffer.seek(0)
-
+        num_of_partitions = math.ceil(len(df.index) / self._copy_chunksize)
+        workers = max(1, min(self._copy_workers, num_of_partitions))
+        engine = get_engine()
+        # closing the pooled connections hands them back to the engine's pool instead of leaving it to the GC
+        with ExitStack() as stack:
+            connections = [stack.enter_context(closing(engine.raw_connection())) for _ in range(workers)]
+            # psycopg2 opens a transaction per connection on its first COPY. They are only committed once every COPY
+            # succeeded, but one by one, so a failing commit leaves the connections committed before it stored.
             try:
-                # Specifying the columns, to make sure that the order of columns in the dataframe and the db is the same
-                cursor.copy_from(
-                    buffer,
-                    self._save_args["name"],
-                    sep=",",
-                    columns=["sample_id", "score", "prediction", "context_id"],
-                )
-                conn.commit()
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(
+                        executor.map(
+                            self._copy_partitions,
+                            connections,
+                            [df] * workers,
+                            [
+                                islice(iter_partition_indexes(len(df.index), self._copy_chunksize), i, None, workers)
+                                for i in range(workers)
+                            ],
+                        )
+                    )
+                for conn in connections:
+                    conn.commit()
             except Exception as error:
                 logging.error(error)
-                conn.rollback()
-                cursor.close()
-                exit(-1)
+                for conn in connections:
+                    conn.rollback()
+                raise DataSetError(f"Failed to copy the outlier scores to {self._table_name}") from error
 
-        cursor.close()
+    def _copy_partitions(self, conn, df: pd.DataFrame, partitions: Iterable[Tuple[int, int]]) -> None:
+        """
+        COPY the given partitions of the dataframe over one connection, without committing.
+        """
+        with closing(conn.cursor()) as cursor:
+            for value in partitions:
+                cursor.copy_expert(_COPY_STMT, IterStream(_binary_copy(df.iloc[value[0] : value[1]])))
@@ -41,12 +41,21 @@ The gateway logic is now automatically applied before and after a tagged node is
 #  SOFTWARE.
 
 import logging
-from typing import Dict, Any
+from itertools import count
+from typing import Dict, Any, Iterator, List
 from pandas import DataFrame
 from kedro.pipeline.node import Node
 from pandas.api.types import is_numeric_dtype
 
-waldo_gateway_registry = []
+
+class WaldoValidationError(Exception):
+    """Raised by a gateway if the input or output of a node is invalid."""
+
+
+# registered gateways, indexed by each of their tags
+waldo_gateway_registry: Dict[str, List["WaldoGateway"]] = {}
+# numbers the gateways in the order they are registered, which is the order they validate a node in
+_registration_counter = count()
 
 
 class WaldoGateway(object):
@@ -57,10 +66,10 @@ class WaldoGateway(object):
     """
 
     def __init__(self, tag=None):
-        waldo_gateway_registry.append(self)
-        self.tags = {self.__class__.__name__}
-        if tag:
-            self.tags.add(tag)
+        self.tags = frozenset((self.__class__.__name__,) + ((tag,) if tag else ()))
+        self._registration_index = next(_registration_counter)
+        for gateway_tag in self.tags:
+            waldo_gateway_registry.setdefault(gateway_tag, []).append(self)
         super().__init__()
 
     def validate_input(self, node: Node, inputs: Dict[str, Any]):
@@ -108,6 +117,7 @@ class NumericInputValidatorGateway(WaldoGateway):
             inputs: Pandas Dataframe
         :return:
             True: If all the parameters sent to a node are numeric
+        :raises WaldoValidationError: If the dataset or the parameters are missing or not numeric
         """
 
         valid: bool = True
@@ -124,25 +134,35 @@ class NumericInputValidatorGateway(WaldoGateway):
 
         # checks if the types of the columns defined in params, are numeric inside the dataset dataframes
         if not dataset.empty and params:
-            for param in params:
-                if not is_numeric_dtype(dataset.dtypes[param]):
-                    valid = False
-                    break
+            valid = bool(dataset.dtypes[params].map(is_numeric_dtype).all())
 
             if valid:
                 logging.info(f"All the parameters {params} are numeric inside the input dataset {dataset_name}")
                 return valid
         else:
-            logging.error(f"Either dataset or the parameters are missing in the node input")
-            exit(-1)
+            message = f"Either dataset or the parameters are missing in the input of node {node.name}"
+            logging.error(message)
+            raise WaldoValidationError(message)
 
-        logging.error(f"All the parameters {params} inside the input dataset {dataset_name} are not numeric")
-        exit(-1)
+        message = f"All the parameters {params} inside the input dataset {dataset_name} are not numeric"
+        logging.error(message)
+        raise WaldoValidationError(message)
 
     def validate_output(self, node: Node, outputs: Dict[str, Any]):
         """Empty"""
 
 
+def _matching_gateways(node: Node) -> Iterator[WaldoGateway]:
+    """
+    Look up the registered gateways by the tags of a node, each gateway is returned once, in registration order.
+
+    :param node: The node whose tags select the gateways.
+    """
+    # the tags of a node are a set, the gateways are collected first so their order does not depend on its iteration
+    matches = {id(gateway): gateway for tag in node.tags for gateway in waldo_gateway_registry.get(tag, ())}
+    yield from sorted(matches.values(), key=lambda gateway: gateway._registration_index)
+
+
 def validate_node_input(node: Node, inputs: Dict[str, Any]):
     """
     Execute input validation function for each gateway registered via its `__init__` method.
@@ -150,9 +170,8 @@ def validate_node_input(node: Node, inputs: Dict[str, Any]):
     :param node: The node that triggered this hook function.
     :param inputs: Dictionary of inputs to be validated by the gateway (if the node's tags match)
     """
-    for gateway in waldo_gateway_registry:
-        if gateway.tags.intersection(node.tags):
-            gateway.validate_input(node, inputs)
+    for gateway in _matching_gateways(node):
+        gateway.validate_input(node, inputs)
 
 
 def validate_node_output(node: Node, outputs: Dict[str, Any]):
@@ -162,6 +181,5 @@ def validate_node_output(node: Node, outputs: Dict[str, Any]):
     :param node: The node that triggered this hook function.
     :param outputs: Dictionary of outputs to be validated by the gateway (if the node's tags match)
     """
-    for gateway in waldo_gateway_registry:
-        if gateway.tags.intersection(node.tags):
-            gateway.validate_output(node, outputs)
+    for gateway in _matching_gateways(node):
+        gateway.validate_output(node, outputs)
@@ -2,46 +2,76 @@
 Generic Kedro Nodes
 """
 
+import hashlib
 import logging
-import json
+from collections import OrderedDict
+from contextlib import nullcontext
+from threading import Lock
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+from joblib import parallel_backend
 from sklearn.ensemble import IsolationForest
 from sklearn.covariance import EllipticEnvelope
 from sklearn.neighbors import LocalOutlierFactor
 from .plugin import hooks
+from .utilities import to_json
+import numpy as np
 import pandas as pd
 from .views import ADAlgorithms, create_samples_os_view
 
-iso_params = {
-    "IsolationForest.n_estimators": 100,
-    "IsolationForest.max_samples": "auto",
-    "IsolationForest.contamination": "auto",
-    "IsolationForest.max_features": 1.0,
-    "IsolationForest.bootstrap": False,
-    "IsolationForest.n_jobs": None,
-    "IsolationForest.random_state": None,
-    "IsolationForest.verbose": 0,
-    "IsolationForest.warm_start": False,
-}
+# read-only defaults, keyed on the sklearn parameter names. Every fit merges its own copy with the node parameters.
+iso_params = MappingProxyType(
+    {
+        "n_estimators": 100,
+        "max_samples": "auto",
+        "contamination": "auto",
+        "max_features": 1.0,
+        "bootstrap": False,
+        "n_jobs": None,
+        "random_state": None,
+        "verbose": 0,
+        "warm_start": False,
+    }
+)
 
-ell_params = {
-    "EllipticEnvelope.store_precision": True,
-    "EllipticEnvelope.assume_centered": False,
-    "EllipticEnvelope.support_fraction": None,
-    "EllipticEnvelope.contamination": 0.1,
-    "EllipticEnvelope.random_state": None,
-}
+ell_params = MappingProxyType(
+    {
+        "store_precision": True,
+        "assume_centered": False,
+        "support_fraction": None,
+        "contamination": 0.1,
+        "random_state": None,
+    }
+)
 
-local_params = {
-    "LocalOutlierFactor.n_neighbors": 20,
-    "LocalOutlierFactor.algorithm": "auto",
-    "LocalOutlierFactor.leaf_size": 30,
-    "LocalOutlierFactor.metric": "minkowski",
-    "LocalOutlierFactor.p": 2,
-    "LocalOutlierFactor.metric_params": None,
-    "LocalOutlierFactor.contamination": "auto",
-    "LocalOutlierFactor.novelty": False,
-    "LocalOutlierFactor.n_jobs": None,
-}
+local_params = MappingProxyType(
+    {
+        "n_neighbors": 20,
+        "algorithm": "auto",
+        "leaf_size": 30,
+        "metric": "minkowski",
+        "p": 2,
+        "metric_params": None,
+        "contamination": "auto",
+        "novelty": False,
+        "n_jobs": None,
+    }
+)
+
+# float32 scores and outlier masks of the most recent fits, keyed on algorithm, input data and parameters. Bounded by
+# the number of entries and by their total size, a single entry larger than the bound is not cached at all.
+_score_cache: "OrderedDict[Tuple[ADAlgorithms, bytes, str], Tuple[np.ndarray, np.ndarray]]" = OrderedDict()
+_score_cache_lock = Lock()
+_SCORE_CACHE_SIZE = 8
+_SCORE_CACHE_BYTES = 256 * 2 ** 20
+
+# dtype of the input columns, unless the node parameters give one
+_DEFAULT_DTYPES = MappingProxyType(
+    {
+        ADAlgorithms.IsolationForest: "float32",
+        ADAlgorithms.LocalOutlierFactor: "float64",
+    }
+)
 
 
 def isolation_forest(data: pd.DataFrame, params: dict) -> pd.DataFrame:
@@ -55,8 +85,9 @@ def isolation_forest(data: pd.DataFrame, params: dict) -> pd.DataFrame:
     :return: a dataframes with anomaly detection scores and predictions
     """
 
-    create_samples_os_view(ADAlgorithms.IsolationForest, params)
-    return outlier_score(ADAlgorithms.IsolationForest, data, params)
+    parameters = to_json(params, sort_keys=True)
+    create_samples_os_view(ADAlgorithms.IsolationForest, parameters)
+    return outlier_score(ADAlgorithms.IsolationForest, data, params, parameters)
 
 
 def elliptic_envelope(data: pd.DataFrame, params: dict) -> pd.DataFrame:
@@ -70,8 +101,9 @@ def elliptic_envelope(data: pd.DataFrame, params: dict) -> pd.DataFrame:
     :return: a dataframes with anomaly detection scores and predictions
     """
 
-    create_samples_os_view(ADAlgorithms.EllipticEnvelope, params)
-    return outlier_score(ADAlgorithms.EllipticEnvelope, data, params)
+    parameters = to_json(params, sort_keys=True)
+    create_samples_os_view(ADAlgorithms.EllipticEnvelope, parameters)
+    return outlier_score(ADAlgorithms.EllipticEnvelope, data, params, parameters)
 
 
 def local_outlier_factor(data: pd.DataFrame, params: dict) -> pd.DataFrame:
@@ -85,79 +117,197 @@ def local_outlier_factor(data: pd.DataFrame, params: dict) -> pd.DataFrame:
     :return: a dataframes with anomaly detection scores and predictions
     """
 
-    create_samples_os_view(ADAlgorithms.LocalOutlierFactor, params)
-    return outlier_score(ADAlgorithms.LocalOutlierFactor, data, params)
+    parameters = to_json(params, sort_keys=True)
+    create_samples_os_view(ADAlgorithms.LocalOutlierFactor, parameters)
+    return outlier_score(ADAlgorithms.LocalOutlierFactor, data, params, parameters)
 
 
-def outlier_score(algo: ADAlgorithms, data: pd.DataFrame, params: dict) -> pd.DataFrame:
+def outlier_score(
+    algo: ADAlgorithms, data: pd.DataFrame, params: dict, parameters: Optional[str] = None
+) -> pd.DataFrame:
     """
     calculate outlier score using the algorithm that has been specified by one of the wrapper functions
     (e.g. isolation forest, eliptic curve or local outlier factor).
+    Repeated calls with the same algorithm, data and parameters reuse the scores of the previous fit.
+    The input columns are converted to ``params.dtype``, by default float32 for the isolation forest and float64 for
+    the local outlier factor. The elliptic envelope always uses float64.
 
     :param algo: algorithm to be used for the outlier detection.
     :param data: input dataframe.
     :param params: module specific parameters.
+    :param parameters: ``params`` serialized as JSON with sorted keys, if the caller already has it.
     :return: a dataframe with os metric (outlier score, prediction, used algorithm and parameters)
     """
+    if parameters is None:
+        parameters = to_json(params, sort_keys=True)
     cols = params["cols"]
-    x = data[cols].to_numpy()
+    # the isolation forest works on float32 internally anyway. The neighbour trees of the local outlier factor convert
+    # their data to float64, and the covariance estimation of the elliptic envelope needs float64.
+    if algo == ADAlgorithms.EllipticEnvelope:
+        dtype = "float64"
+    else:
+        dtype = params.get("dtype", _DEFAULT_DTYPES[algo])
     try:
-        if algo == ADAlgorithms.IsolationForest:
-            try:
-                iso_params.update(params["IsolationForest"])
-            except KeyError:
-                logging.info(
-                    "No parameters for Isolation Forest found, using the default ones"
-                )
-            algo_obj: IsolationForest = IsolationForest(
-                n_estimators=iso_params["IsolationForest.n_estimators"],
-                max_samples=iso_params["IsolationForest.max_samples"],
-                contamination=iso_params["IsolationForest.contamination"],
-                max_features=iso_params["IsolationForest.max_features"],
-                bootstrap=iso_params["IsolationForest.bootstrap"],
-                n_jobs=iso_params["IsolationForest.n_jobs"],
-                random_state=iso_params["IsolationForest.random_state"],
-                verbose=iso_params["IsolationForest.verbose"],
-                warm_start=iso_params["IsolationForest.warm_start"],
-            ).fit(x)
-            ols = -algo_obj.score_samples(x)
-            prd = algo_obj.predict(x)
-        elif algo == ADAlgorithms.EllipticEnvelope:
-            try:
-                ell_params.update(params["EllipticEnvelope"])
-            except KeyError:
-                logging.info(
-                    "No parameters for Elliptic Envelope found, using the default ones"
-                )
-            algo_obj: EllipticEnvelope = EllipticEnvelope(
-                store_precision=ell_params["EllipticEnvelope.store_precision"],
-                assume_centered=ell_params["EllipticEnvelope.assume_centered"],
-                support_fraction=ell_params["EllipticEnvelope.support_fraction"],
-                contamination=ell_params["EllipticEnvelope.contamination"],
-                random_state=ell_params["EllipticEnvelope.random_state"],
-            ).fit(x)
-            ols = -algo_obj.score_samples(x)
-            prd = algo_obj.predict(x)
-        elif algo == ADAlgorithms.LocalOutlierFactor:
-            try:
-                local_params.update(params["LocalOutlierFactor"])
-            except KeyError:
-                logging.info(
-                    "No parameters for Local Outlier Factor found, using the default ones"
-                )
-            algo_obj: LocalOutlierFactor = LocalOutlierFactor(
-                n_neighbors=local_params["LocalOutlierFactor.n_neighbors"],
-                algorithm=local_params["LocalOutlierFactor.algorithm"],
-                leaf_size=local_params["LocalOutlierFactor.leaf_size"],
-                metric=local_params["LocalOutlierFactor.metric"],
-                p=local_params["LocalOutlierFactor.p"],
-                metric_params=local_params["LocalOutlierFactor.metric_params"],
-                contamination=local_params["LocalOutlierFactor.contamination"],
-                novelty=local_params["LocalOutlierFactor.novelty"],
-                n_jobs=local_params["LocalOutlierFactor.n_jobs"],
-            ).fit(x)
-            ols = -algo_obj.negative_outlier_factor_
-            prd = algo_obj.fit_predict(x)
+        x = _feature_matrix(data, cols, dtype)
+    except (TypeError, ValueError) as e:
+        # e.g. a non-numeric column or missing values
+        logging.error(e)
+        raise Exception(f"Could not run {algo.value}") from e
+    scores, predictions = _cached_fit_score(algo, x, params, parameters)
+
+    # all columns at once, so pandas lays out its blocks only once; the scalars are broadcast to every row
+    os_df: pd.DataFrame = pd.DataFrame(
+        {
+            "sample_id": data["id"].to_numpy(),
+            "run_id": hooks.run_id,
+            "score": scores,
+            "algorithm": algo.value,
+            "parameters": parameters,
+            "prediction": predictions,
+        }
+    )
+
+    return os_df
+
+
+def _feature_matrix(data: pd.DataFrame, cols: List[str], dtype: Any) -> np.ndarray:
+    """
+    copy the input columns into a row-major array of the given dtype. sklearn walks the samples row by row, a row-major
+    array keeps the features of a sample in one cache line. The columns are written straight into the array, without
+    the intermediate column-major copy of ``data[cols].to_numpy()``.
+
+    :param data: input dataframe.
+    :param cols: input columns.
+    :param dtype: dtype of the array.
+    :return: array of shape (samples, columns)
+    """
+    x = np.empty((len(data.index), len(cols)), dtype=dtype, order="C")
+    for i, col in enumerate(cols):
+        x[:, i] = data[col].to_numpy()
+    return x
+
+
+def _cached_fit_score(
+    algo: ADAlgorithms, x: np.ndarray, params: dict, parameters: str
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    look up the scores and predictions of a previous fit with the same algorithm, input data and parameters,
+    fit the model only if there is none.
+
+    :param algo: algorithm to be used for the outlier detection.
+    :param x: input data.
+    :param params: module specific parameters.
+    :param parameters: ``params`` serialized as JSON with sorted keys.
+    :return: float32 outlier scores and predictions (True for outliers)
+    """
+    if x.dtype == object:
+        # only with an explicit `dtype: object` in the node parameters. Object arrays hold pointers, their memory cannot
+        # identify the data (nor be hashed), so they are fitted without the cache.
+        return _compact_scores(*_fit_score(algo, x, params))
+
+    digest = hashlib.blake2b(np.ascontiguousarray(x), digest_size=16)
+    digest.update(str((x.shape, x.dtype)).encode("UTF-8"))
+    key = (algo, digest.digest(), parameters)
+
+    with _score_cache_lock:
+        if key in _score_cache:
+            _score_cache.move_to_end(key)
+            return _score_cache[key]
+
+    result = _compact_scores(*_fit_score(algo, x, params))
+    with _score_cache_lock:
+        _score_cache[key] = result
+        cached_bytes = sum(scores.nbytes + predictions.nbytes for scores, predictions in _score_cache.values())
+        while _score_cache and (len(_score_cache) > _SCORE_CACHE_SIZE or cached_bytes > _SCORE_CACHE_BYTES):
+            scores, predictions = _score_cache.popitem(last=False)[1]
+            cached_bytes -= scores.nbytes + predictions.nbytes
+    return result
+
+
+def _compact_scores(ols: np.ndarray, prd: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    convert the scores and predictions of a model to the dtypes of the outlier score columns. float32 precision
+    suffices for outlier scores, the predictions (1 for inliers, -1 for outliers) become a 1 byte per row outlier mask.
+
+    :param ols: outlier scores.
+    :param prd: predictions.
+    :return: float32 outlier scores and predictions (True for outliers)
+    """
+    return ols.astype(np.float32), np.equal(prd, -1)
+
+
+def _model_params(algo: ADAlgorithms, defaults: Mapping[str, Any], params: dict) -> Dict[str, Any]:
+    """
+    merge the default parameters of the model with the ones given for it in ``params``. The keys may be given with
+    the algorithm prefix (e.g. ``IsolationForest.n_estimators``) or as the plain sklearn parameter name.
+
+    :param algo: algorithm to be used for the outlier detection.
+    :param defaults: default parameters of the model.
+    :param params: module specific parameters.
+    :return: keyword arguments for the model
+    """
+    if algo.name not in params:
+        logging.info(f"No parameters for {algo.value} found, using the default ones")
+        return dict(defaults)
+    return {**defaults, **{key.rpartition(".")[2]: value for key, value in params[algo.name].items()}}
+
+
+def _build_isolation_forest(params: dict) -> IsolationForest:
+    """build the isolation forest model from the module specific parameters."""
+    return IsolationForest(**_model_params(ADAlgorithms.IsolationForest, iso_params, params))
+
+
+def _build_elliptic_envelope(params: dict) -> EllipticEnvelope:
+    """build the elliptic envelope model from the module specific parameters."""
+    return EllipticEnvelope(**_model_params(ADAlgorithms.EllipticEnvelope, ell_params, params))
+
+
+def _build_local_outlier_factor(params: dict) -> LocalOutlierFactor:
+    """build the local outlier factor model from the module specific parameters."""
+    return LocalOutlierFactor(**_model_params(ADAlgorithms.LocalOutlierFactor, local_params, params))
+
+
+def _score_samples(algo_obj: Any, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """outlier scores and predictions of a fitted model that can score the samples it was fitted on."""
+    return -algo_obj.score_samples(x), algo_obj.predict(x)
+
+
+def _score_local_outlier_factor(algo_obj: LocalOutlierFactor, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """outlier scores and predictions of the samples a local outlier factor model was fitted on."""
+    # same thresholding as fit_predict, without building the neighbour graph a second time
+    prd = np.where(algo_obj.negative_outlier_factor_ < algo_obj.offset_, -1, 1)
+    return -algo_obj.negative_outlier_factor_, prd
+
+
+# model builder and scorer of every algorithm, the scorer returns the outlier scores and predictions of the fitted model
+_ALGO_DISPATCH: Dict[
+    ADAlgorithms, Tuple[Callable[[dict], Any], Callable[[Any, np.ndarray], Tuple[np.ndarray, np.ndarray]]]
+] = {
+    ADAlgorithms.IsolationForest: (_build_isolation_forest, _score_samples),
+    ADAlgorithms.EllipticEnvelope: (_build_elliptic_envelope, _score_samples),
+    ADAlgorithms.LocalOutlierFactor: (_build_local_outlier_factor, _score_local_outlier_factor),
+}
+
+# fitted and scored on all cores unless n_jobs is configured, threads share x instead of copying it to every worker
+# process (each isolation tree only draws max_samples, by default min(256, n_samples), rows anyway, and the neighbour
+# queries of the local outlier factor run in compiled code that releases the GIL)
+_THREADED_ALGORITHMS = frozenset({ADAlgorithms.IsolationForest, ADAlgorithms.LocalOutlierFactor})
+
+
+def _fit_score(algo: ADAlgorithms, x: np.ndarray, params: dict) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    fit the anomaly detection model on the input data and score it.
+
+    :param algo: algorithm to be used for the outlier detection.
+    :param x: input data.
+    :param params: module specific parameters.
+    :return: outlier scores and predictions (1 for inliers, -1 for outliers)
+    """
+    try:
+        builder, scorer = _ALGO_DISPATCH[algo]
+        algo_obj = builder(params)
+        with parallel_backend("threading", n_jobs=-1) if algo in _THREADED_ALGORITHMS else nullcontext():
+            ols, prd = scorer(algo_obj.fit(x), x)
     except MemoryError as e:
         logging.error(e)
         raise Exception("Ran out of memory") from e
@@ -165,15 +315,4 @@ def outlier_score(algo: ADAlgorithms, data: pd.DataFrame, params: dict) -> pd.Da
         logging.error(e)
         raise Exception(f"Could not run {algo.value}") from e
 
-    # 1 for inliers, -1 for outliers.
-    predictions: list[bool] = [x == -1 for x in prd]
-
-    os_df: pd.DataFrame = pd.DataFrame()
-    os_df["sample_id"] = data["id"]
-    os_df["run_id"] = hooks.trace_id
-    os_df["score"] = ols
-    os_df["algorithm"] = algo.value
-    os_df["parameters"] = json.dumps(params)
-    os_df["prediction"] = predictions
-
-    return os_df
+    return ols, prd
@@ -23,26 +23,40 @@ Hooks for the plugin
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #  SOFTWARE.
 
-import json
+import atexit
 import logging
+import os
+import queue
+import threading
 from kedro.framework.hooks import hook_impl
 from kedro.io import DataCatalog
 from kedro.pipeline.node import Node
 from kedro.pipeline import Pipeline
-from typing import Dict, Any
-import inspect
+from typing import Any, Dict, List, Optional, Set, Tuple, Type
 from kedro_viz.api import responses
 from .utilities import (
     populate_data,
-    insert_event,
-    insert_catalog,
-    insert_pipeline,
+    calc_hash,
+    to_json,
+    event_values,
+    insert_rows,
+    stored_hashes,
     get_session,
     emit_ddl,
 )
+from .models import Base, Catalogs, Events, Pipelines
 from . import gateway
 import uuid
 
+# the row writer coalesces up to this many rows per transaction, waiting at most this many seconds for a batch to fill
+_ROW_BATCH_SIZE = 128
+_ROW_BATCH_TIMEOUT = 0.1
+# rows which are already queued are taken along without waiting, up to this many per transaction, so a backlog built
+# up while the database was busy is written in large batches
+_ROW_BACKLOG_SIZE = 20000
+# seconds the interpreter waits on exit for the rows which are still queued
+_ROW_EXIT_TIMEOUT = 10
+
 
 class MyHooks:
     """
@@ -51,6 +65,128 @@ class MyHooks:
 
     def __init__(self):
         self.trace_id = uuid.uuid1()
+        # string form of the trace id, as stored in the `run_id` columns
+        self.run_id = str(self.trace_id)
+        # events, catalogs and pipelines are written by a background thread, so the hooks do not wait for the database
+        self._rows: "queue.Queue[Tuple[Type[Base], Dict[str, Any]]]" = queue.Queue()
+        self._row_writer = threading.Thread(target=self._write_rows, name="waldo-row-writer", daemon=True)
+        self._row_writer.start()
+        # worker processes forked by the ParallelRunner inherit the queue, but not the thread draining it
+        self._pid = os.getpid()
+        # the daemon thread is stopped on exit, so rows queued outside a pipeline run (e.g. in a notebook) are written
+        # before that
+        atexit.register(self._flush_rows_at_exit)
+        # catalogs and pipelines stored before or queued by this process, each is only written once. Loaded on first
+        # use, the hashes of a batch that failed to commit are removed again.
+        self._queued_hashes: Optional[Set[Tuple[Type[Base], str]]] = None
+        # kedro-viz structures of the pipelines run so far, keyed on pipeline name, pipeline and catalog datasets
+        self._structures: Dict[Tuple[str, str, Tuple[str, ...]], str] = {}
+
+    def _record_event(
+        self, event_type: str, target: str, target_name: Optional[str] = None, target_hash: Optional[str] = None
+    ) -> None:
+        """
+        Queue an event of this run for the `events` table, it is timestamped now and written by `_write_rows`
+        :param event_type: name of the hook
+        :param target: content the target id is hashed from
+        :param target_name: name of the target
+        :param target_hash: `calc_hash` of the target, if the caller already has it
+        :return: None
+        """
+        self._put_row(Events, event_values(self.run_id, event_type, target, target_name, target_hash))
+
+    def _record_once(self, model: Type[Base], values: Dict[str, Any]) -> None:
+        """
+        Queue a row for the `catalogs` or `pipelines` table, unless a row with the same hash is already stored or was
+        queued before
+        :param model: model of the table
+        :param values: column values of the row, including its `hash`
+        :return: None
+        """
+        if self._queued_hashes is None:
+            with get_session() as session:
+                self._queued_hashes = {
+                    (stored_model, stored_hash)
+                    for stored_model in (Catalogs, Pipelines)
+                    for stored_hash in stored_hashes(session, stored_model)
+                }
+        key = (model, values["hash"])
+        if key not in self._queued_hashes:
+            self._queued_hashes.add(key)
+            self._put_row(model, values)
+
+    def _put_row(self, model: Type[Base], values: Dict[str, Any]) -> None:
+        """
+        Queue a row for the row writer thread. A forked worker process has no writer thread and its copy of the queue
+        may have been forked while locked, so the row is written right away instead
+        :param model: model of the table
+        :param values: column values of the row
+        :return: None
+        """
+        if os.getpid() == self._pid:
+            self._rows.put((model, values))
+        else:
+            self._write_batch([(model, values)])
+
+    def _write_batch(self, rows: List[Tuple[Type[Base], Dict[str, Any]]]) -> None:
+        """
+        Write rows in one transaction. If it fails, the hashes of its catalogs and pipelines are forgotten again, so a
+        later hook call queues them once more
+        :param rows: model and column values of every row
+        :return: None
+        """
+        written = False
+        try:
+            # the thread's session is reused, closing it returns the connection to the pool between batches
+            with get_session() as session:
+                written = insert_rows(session, rows)
+        except Exception as err:
+            # the writer thread has to survive a failed batch, or waiting for the queue would block forever
+            logging.error(err)
+        if not written and self._queued_hashes is not None:
+            for model, values in rows:
+                if model is not Events:
+                    self._queued_hashes.discard((model, values["hash"]))
+
+    def _write_rows(self) -> None:
+        """
+        Body of the row writer thread. Drains the row queue for the lifetime of the process, every batch of
+        rows that arrive close together is written in one transaction.
+        :return: None
+        """
+        while True:
+            rows: List[Tuple[Type[Base], Dict[str, Any]]] = [self._rows.get()]
+            try:
+                while len(rows) < _ROW_BATCH_SIZE:
+                    rows.append(self._rows.get(timeout=_ROW_BATCH_TIMEOUT))
+                while len(rows) < _ROW_BACKLOG_SIZE:
+                    rows.append(self._rows.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                self._write_batch(rows)
+            finally:
+                for _ in rows:
+                    self._rows.task_done()
+
+    def _flush_rows(self) -> None:
+        """
+        Wait until the row writer thread has written all queued rows
+        :return: None
+        """
+        self._rows.join()
+
+    def _flush_rows_at_exit(self) -> None:
+        """
+        Wait until the row writer thread has written all queued rows, but at most `_ROW_EXIT_TIMEOUT` seconds, so an
+        unreachable database does not keep the interpreter from exiting
+        :return: None
+        """
+        if os.getpid() != self._pid:
+            return
+        with self._rows.all_tasks_done:
+            if not self._rows.all_tasks_done.wait_for(lambda: not self._rows.unfinished_tasks, _ROW_EXIT_TIMEOUT):
+                logging.error(f"{self._rows.unfinished_tasks} queued rows were not written before exiting")
 
     @hook_impl
     def after_catalog_created(self, conf_catalog: Dict[str, Any]) -> None:
@@ -61,12 +197,13 @@ class MyHooks:
         :param conf_catalog: catalog configuration provided by kedro @hook_spec
         :return: None
         """
-        target = json.dumps(conf_catalog, sort_keys=True)
+        target = to_json(conf_catalog, sort_keys=True)
         logging.info(f"Catalog {target} loaded")
 
-        with get_session() as session:
-            insert_event(session, self.trace_id, inspect.stack()[0][3], target, None)
-            insert_catalog(session, target)
+        # the serialized catalog is hashed once for both the event and the catalogs row
+        target_hash = calc_hash(target)
+        self._record_event("after_catalog_created", target, target_hash=target_hash)
+        self._record_once(Catalogs, dict(hash=target_hash, content=target))
 
     @hook_impl
     def before_node_run(self, node: Node, inputs: Dict[str, Any]) -> None:
@@ -81,8 +218,7 @@ class MyHooks:
         gateway.validate_node_input(node, inputs)
         logging.info(f"Running node {node.name}")
 
-        with get_session() as session:
-            insert_event(session, self.trace_id, inspect.stack()[0][3], node.name, None)
+        self._record_event("before_node_run", node.name)
 
     @hook_impl
     def after_node_run(self, node: Node, outputs: Dict[str, Any]) -> None:
@@ -97,8 +233,7 @@ class MyHooks:
         gateway.validate_node_output(node, outputs)
         logging.info(f"node {node.name} run successfully")
 
-        with get_session() as session:
-            insert_event(session, self.trace_id, inspect.stack()[0][3], node.name, None)
+        self._record_event("after_node_run", node.name)
 
     @hook_impl
     def on_node_error(self, node: Node) -> None:
@@ -109,8 +244,7 @@ class MyHooks:
         :return: None
         """
         logging.info(f"running node {node.name} failed")
-        with get_session() as session:
-            insert_event(session, self.trace_id, inspect.stack()[0][3], node.name, None)
+        self._record_event("on_node_error", node.name)
 
     @hook_impl
     def before_pipeline_run(
@@ -129,18 +263,21 @@ class MyHooks:
         if pipeline_name is None:
             pipeline_name = "__default__"
 
-        logging.info(f"before running pipeline: {pipeline}")
+        target = str(pipeline)
+        target_hash = calc_hash(target)
+        logging.info(f"before running pipeline: {target}")
 
-        pipelines = {pipeline_name: pipeline}
-        populate_data(catalog, pipelines)
-        res = responses.get_default_response()
-        structure: str = res.json(sort_keys=True)
+        structure_key = (pipeline_name, target, tuple(catalog.list()))
+        structure: Optional[str] = self._structures.get(structure_key)
+        if structure is None:
+            pipelines = {pipeline_name: pipeline}
+            populate_data(catalog, pipelines)
+            res = responses.get_default_response()
+            structure = to_json(res.dict(), sort_keys=True)
+            self._structures[structure_key] = structure
 
-        with get_session() as session:
-            insert_event(
-                session, self.trace_id, inspect.stack()[0][3], str(pipeline), None
-            )
-            insert_pipeline(session, str(pipeline), pipeline_name, structure)
+        self._record_event("before_pipeline_run", target, target_hash=target_hash)
+        self._record_once(Pipelines, dict(hash=target_hash, name=pipeline_name, content=structure))
 
     @hook_impl
     def after_pipeline_run(self, pipeline: Pipeline) -> None:
@@ -151,15 +288,16 @@ class MyHooks:
         :return: None
         """
 
+        target = str(pipeline)
+        self._record_event("after_pipeline_run", target)
+        self._flush_rows()
+        # the memoized hashes only live for one run, so long-lived interpreters (e.g. notebooks) do not accumulate them
+        calc_hash.cache_clear()
         with get_session() as session:
-            insert_event(
-                session, self.trace_id, inspect.stack()[0][3], str(pipeline), None
-            )
-
             # Emit created materialized views to the db during this run
             emit_ddl(session)
 
-        logging.info(f"pipeline {pipeline} run successfully")
+        logging.info(f"pipeline {target} run successfully")
 
     @hook_impl
     def on_pipeline_error(self, pipeline: Pipeline) -> None:
@@ -170,12 +308,12 @@ class MyHooks:
         :return: None
         """
 
-        with get_session() as session:
-            insert_event(
-                session, self.trace_id, inspect.stack()[0][3], str(pipeline), None
-            )
+        target = str(pipeline)
+        self._record_event("on_pipeline_error", target)
+        self._flush_rows()
+        calc_hash.cache_clear()
 
-        logging.info(f"running pipeline {pipeline} failed")
+        logging.info(f"running pipeline {target} failed")
 
     @hook_impl
     def before_dataset_loaded(self, dataset_name: str) -> None:
@@ -187,14 +325,7 @@ class MyHooks:
         """
         logging.info(f"loading dataset {dataset_name}")
 
-        with get_session() as session:
-            insert_event(
-                session,
-                self.trace_id,
-                inspect.stack()[0][3],
-                dataset_name,
-                dataset_name,
-            )
+        self._record_event("before_dataset_loaded", dataset_name, dataset_name)
 
     @hook_impl
     def after_dataset_loaded(self, dataset_name: str) -> None:
@@ -206,14 +337,7 @@ class MyHooks:
         """
         logging.info(f"dataset {dataset_name} loaded successfully")
 
-        with get_session() as session:
-            insert_event(
-                session,
-                self.trace_id,
-                inspect.stack()[0][3],
-                dataset_name,
-                dataset_name,
-            )
+        self._record_event("after_dataset_loaded", dataset_name, dataset_name)
 
     @hook_impl
     def before_dataset_saved(self, dataset_name: str) -> None:
@@ -225,14 +349,7 @@ class MyHooks:
         """
         logging.info(f"saving dataset {dataset_name}")
 
-        with get_session() as session:
-            insert_event(
-                session,
-                self.trace_id,
-                inspect.stack()[0][3],
-                dataset_name,
-                dataset_name,
-            )
+        self._record_event("before_dataset_saved", dataset_name, dataset_name)
 
     @hook_impl
     def after_dataset_saved(self, dataset_name: str) -> None:
@@ -244,14 +361,7 @@ class MyHooks:
         """
         logging.info(f"dataset {dataset_name} saved successfully")
 
-        with get_session() as session:
-            insert_event(
-                session,
-                self.trace_id,
-                inspect.stack()[0][3],
-                dataset_name,
-                dataset_name,
-            )
+        self._record_event("after_dataset_saved", dataset_name, dataset_name)
 
 
 hooks = MyHooks()
@@ -23,19 +23,27 @@ Utility functions for the plugin
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #  SOFTWARE.
 
-import hashlib
+import io
+import os
+import time
+from collections import OrderedDict
+from contextlib import closing
+from functools import lru_cache
+from threading import Lock
 import uuid
 
-import math
+import orjson
+import xxhash
 from kedro_viz.data_access import data_access_manager
 from kedro_viz.services import layers_services
 from datetime import datetime
 from kedro.io import DataCatalog
 from kedro.pipeline import Pipeline
-from typing import Dict, List, Tuple
-from sqlalchemy.orm import Session
+from typing import Any, Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, Tuple, Type
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
 from kedro.config import ConfigLoader
 import sqlalchemy
+from sqlalchemy.dialects import postgresql
 import logging
 from .models import Events, Pipelines, Catalogs, Base, Contexts
 
@@ -46,50 +54,166 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
-# Will create the engine globally just once
-conf_paths = ["conf/base"]
-conf_loader = ConfigLoader(conf_paths)
-# Connects to in-memory sqlite db if catalog configuration file cannot be accessed
-conn_str = "sqlite://"
-try:
-    conf_cred = conf_loader.get("credentials*")
-    conn_str = conf_cred["postgres"]["con"]
-except ValueError as err:
-    logging.error(err)
+# one session per thread, reused by every `get_session` call. The rows are added explicitly, so autoflush is not
+# needed, and the committed objects stay readable without reloading them. Bound to the engine once it is built.
+_Session = scoped_session(sessionmaker(future=True, expire_on_commit=False, autoflush=False))
+# the hooks' row writer thread and the runner threads may ask for the engine at the same time
+_engine_lock = Lock()
+# whether `emit_ddl` created the tables already, and the DDL listeners of the views it emitted since
+_tables_created = False
+_emitted_ddl: Set[int] = set()
+_ddl_lock = Lock()
+# sorted layers of the most recent kedro-viz graphs, see `_sort_layers`
+_layers_cache: "OrderedDict[Tuple[FrozenSet, FrozenSet], List[str]]" = OrderedDict()
+_layers_cache_lock = Lock()
+_LAYERS_CACHE_SIZE = 16
 
-Engine = sqlalchemy.create_engine(conn_str, future=True)
+# number of events sent per bulk INSERT by `insert_rows`
+_BULK_CHUNKSIZE = 1000
+# from this many events on, `insert_rows` streams them with COPY on PostgreSQL
+_COPY_EVENTS_THRESHOLD = 5000
+_EVENT_COLUMNS = ("run_id", "event_type", "target_id", "target_name", "timestamp")
+_COPY_EVENTS_STMT = f"COPY {Events.__tablename__} ({','.join(_EVENT_COLUMNS)}) FROM STDIN"
+# characters with a special meaning in the text format of COPY
+_COPY_TEXT_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
 
 
+def _calc_hash_bytes(value: bytes) -> str:
+    """
+    calculate the hash of already encoded content, see `calc_hash`
+    :param value: bytes to calculate the hash for
+    :return: hash string
+    """
+    # only an identifier, a non-cryptographic hash does
+    return xxhash.xxh3_64_hexdigest(value)[:8]
+
+
+@lru_cache(maxsize=4096)
 def calc_hash(value: str) -> str:
     """
-    calculate the hash to be used for `after_catalog_created` and `before_pipeline_run`
+    calculate the hash to be used for `after_catalog_created` and `before_pipeline_run`. Memoized on the string, so a
+    repeated value is neither encoded nor hashed again.
     :param value: string value to calculate the hash for
     :return: hash string
     """
-    return hashlib.sha1(value.encode("UTF-8")).hexdigest()[:8]
+    return _calc_hash_bytes(value.encode("UTF-8"))
+
+
+def to_json(value: Any, sort_keys: bool = False) -> str:
+    """
+    serialize a value to a compact JSON string, e.g. the node parameters or the catalog configuration
+    :param value: JSON serializable value, dictionary keys which are not strings are converted to strings and sets are
+        converted to sorted lists
+    :param sort_keys: whether to sort the keys of the dictionaries, to get the same string for equal values
+    :return: JSON string
+    """
+    option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return orjson.dumps(value, default=_json_default, option=option).decode("UTF-8")
+
+
+def _json_default(value: Any) -> Any:
+    """
+    serialize the values orjson does not support natively, e.g. the tag sets of the kedro-viz nodes
+    :param value: value to serialize
+    :return: JSON serializable replacement of the value
+    """
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=str)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
 
 
 def partition_indexes(total_size: int, chunk_size: int) -> List[Tuple[int, int]]:
     """
     given the total_size of the list or a dataframe and the size of the chunks, it returns the list of tuples,
-    where each tuple contains the starting and ending index for each computed chunk inside a list or a dataframe
+    where each tuple contains the starting and ending index for each computed chunk inside a list or a dataframe.
+    The ranges are half-open, i.e. ``df.iloc[start:end]`` is a chunk, only the last chunk may be smaller.
     :param total_size: length of a list or size of a dataframe
     :param chunk_size: size of the chunk
     :return: list of tuples for chunk's start and end indices
     """
-    # Compute the chunk size (integer division; i.e. assuming Python 2.7)
-    num_of_partitions = math.ceil(total_size / chunk_size)
-    # How many chunks need an extra 1 added to the size?
-    remainder = total_size - chunk_size * num_of_partitions
-    a = 0
-    indexes = []
-    for i in range(num_of_partitions):
-        b = a + chunk_size + (i < remainder)
-        # Yield the inclusive-inclusive range
-        indexes.append((a, b))
-        a = b
+    return [(start, min(start + chunk_size, total_size)) for start in range(0, total_size, chunk_size)]
 
-    return indexes
+
+def iter_partition_indexes(total_size: int, chunk_size: int) -> Iterator[Tuple[int, int]]:
+    """
+    lazy variant of `partition_indexes`, which yields the half-open (start, end) ranges of the chunks one by one
+    :param total_size: length of a list or size of a dataframe
+    :param chunk_size: size of the chunk
+    :return: iterator over tuples for chunk's start and end indices
+    """
+    for start in range(0, total_size, chunk_size):
+        yield start, min(start + chunk_size, total_size)
+
+
+class IterStream(io.RawIOBase):
+    """
+    Read-only file object over an iterable of byte strings. The chunks are only produced when the stream is read, so
+    the full content never has to be held in memory, e.g. when streaming rows into a psycopg2 ``copy_expert`` call.
+    """
+
+    def __init__(self, chunks: Iterable[bytes]):
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._leftover = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._leftover:
+            try:
+                self._leftover = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._leftover))
+        buffer[:size] = self._leftover[:size]
+        self._leftover = self._leftover[size:]
+        return size
+
+
+def _event_rows(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    convert the values built by `event_values` to the column values of the events table. The targets which are not
+    hashed yet are hashed with `calc_hash` and the nanosecond timestamps are converted to local datetimes.
+    :param events: values of the events
+    :return: column values of the events table rows
+    """
+    rows = []
+    for values in events:
+        seconds, nanoseconds = divmod(values["timestamp"], 1_000_000_000)
+        rows.append(
+            dict(
+                run_id=values["run_id"],
+                event_type=values["event_type"],
+                target_id=calc_hash(values["target"]) if values["target_id"] is None else values["target_id"],
+                target_name=values["target_name"],
+                timestamp=datetime.fromtimestamp(seconds).replace(microsecond=nanoseconds // 1000),
+            )
+        )
+    return rows
+
+
+def event_values(
+    run_id: str, event_type: str, target_id: str, target_name: str, target_hash: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    method to build the values of an events table row, timestamped now. Until the event is inserted the timestamp is
+    kept as nanoseconds since the epoch and the target id is kept as is, unless its hash is given
+    :param run_id: run id
+    :param event_type: event type
+    :param target_id: target id
+    :param target_name: target name
+    :param target_hash: `calc_hash` of the target id, if the caller already has it
+    :return: values of the event
+    """
+    return dict(
+        run_id=run_id,
+        event_type=event_type,
+        target=target_id,
+        target_id=target_hash,
+        target_name=target_name,
+        timestamp=time.time_ns(),
+    )
 
 
 def insert_event(session, run_id: uuid, event_type: str, target_id: str, target_name: str) -> Events:
@@ -103,13 +227,7 @@ def insert_event(session, run_id: uuid, event_type: str, target_id: str, target_
     :return: models.Events
     """
     try:
-        new_event = Events(
-            run_id=run_id,
-            event_type=event_type,
-            target_id=calc_hash(target_id),
-            target_name=target_name,
-            timestamp=datetime.now(),
-        )
+        new_event = Events(**_event_rows([event_values(run_id, event_type, target_id, target_name)])[0])
         session.merge(new_event)
         session.commit()
 
@@ -120,16 +238,115 @@ def insert_event(session, run_id: uuid, event_type: str, target_id: str, target_
         return None
 
 
-def insert_catalog(session, target: str) -> Catalogs:
+def _insert_new(session, model: Type[Base], rows: List[Dict[str, Any]]) -> None:
+    """
+    insert rows of a table keyed on their content hash (catalogs or pipelines) with a single executemany, skipping the
+    ones which are already stored instead of looking each of them up like `session.merge`
+    :param session: database session
+    :param model: model of the table
+    :param rows: column values of the rows
+    :return: None
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        stmt = postgresql.insert(model).on_conflict_do_nothing(index_elements=["hash"])
+    elif dialect == "sqlite":
+        stmt = sqlalchemy.insert(model).prefix_with("OR IGNORE")
+    else:
+        for values in rows:
+            session.merge(model(**values))
+        return
+    session.execute(stmt, rows)
+
+
+def _copy_text_rows(rows: List[Dict[str, Any]], columns: Tuple[str, ...]) -> Iterator[bytes]:
+    """
+    encode rows in the tab separated text format of the PostgreSQL COPY command, `_BULK_CHUNKSIZE` rows per chunk
+    :param rows: column values of the rows
+    :param columns: columns in the order of the COPY statement
+    :return: iterator over the encoded chunks
+    """
+    for start in range(0, len(rows), _BULK_CHUNKSIZE):
+        lines = (
+            "\t".join(
+                "\\N" if row[column] is None else str(row[column]).translate(_COPY_TEXT_ESCAPES) for column in columns
+            )
+            for row in rows[start : start + _BULK_CHUNKSIZE]
+        )
+        yield ("\n".join(lines) + "\n").encode("UTF-8")
+
+
+def _copy_events(session, events: List[Dict[str, Any]]) -> None:
+    """
+    stream events into the events table with COPY, within the transaction of the session
+    :param session: database session
+    :param events: column values of the events table rows
+    :return: None
+    """
+    dbapi_connection = session.connection().connection
+    with closing(dbapi_connection.cursor()) as cursor:
+        cursor.copy_expert(_COPY_EVENTS_STMT, IterStream(_copy_text_rows(events, _EVENT_COLUMNS)))
+
+
+def insert_rows(session, rows: Iterable[Tuple[Type[Base], Dict[str, Any]]]) -> bool:
+    """
+    method to insert queued rows of the events, catalogs and pipelines tables in one transaction. The events are
+    bulk inserted in chunks of `_BULK_CHUNKSIZE` (or copied, for large batches on PostgreSQL), catalogs and pipelines
+    which are already stored are skipped.
+    :param session: database session
+    :param rows: model and column values of every row, see `event_values`
+    :return: whether the rows were committed
+    """
+    try:
+        events = []
+        hashed: Dict[Type[Base], List[Dict[str, Any]]] = {}
+        for model, values in rows:
+            if model is Events:
+                events.append(values)
+            else:
+                hashed.setdefault(model, []).append(values)
+        for model, values in hashed.items():
+            _insert_new(session, model, values)
+        events = _event_rows(events)
+        if len(events) >= _COPY_EVENTS_THRESHOLD and session.get_bind().dialect.name == "postgresql":
+            _copy_events(session, events)
+        else:
+            for start in range(0, len(events), _BULK_CHUNKSIZE):
+                session.bulk_insert_mappings(Events, events[start : start + _BULK_CHUNKSIZE])
+        session.commit()
+        return True
+    except sqlalchemy.exc.SQLAlchemyError as err:
+        logging.error(err)
+        session.rollback()
+        return False
+
+
+def stored_hashes(session, model: Type[Base]) -> Set[str]:
+    """
+    method to read the hashes of all rows of a table keyed on their content hash (catalogs or pipelines)
+    :param session: database session
+    :param model: model of the table
+    :return: stored hashes, empty if the table cannot be read (e.g. before the first run created it)
+    """
+    try:
+        return set(session.execute(sqlalchemy.select(model.hash)).scalars())
+    except sqlalchemy.exc.SQLAlchemyError as err:
+        logging.error(err)
+        session.rollback()
+        return set()
+
+
+def insert_catalog(session, target: str, target_hash: Optional[str] = None) -> Catalogs:
     """
     method to insert values to the events table
     :param session: database session
     :param target: target
+    :param target_hash: `calc_hash` of the target, if the caller already has it
     :return: models.Catalogs
     """
     try:
-        new_catalog = Catalogs(hash=calc_hash(target), content=target)
-        session.merge(new_catalog)
+        new_catalog = Catalogs(hash=target_hash or calc_hash(target), content=target)
+        _insert_new(session, Catalogs, [dict(hash=new_catalog.hash, content=new_catalog.content)])
         session.commit()
 
         return new_catalog
@@ -139,18 +356,23 @@ def insert_catalog(session, target: str) -> Catalogs:
         return None
 
 
-def insert_pipeline(session, target: str, name: str, content: str) -> Pipelines:
+def insert_pipeline(
+    session, target: str, name: str, content: str, target_hash: Optional[str] = None
+) -> Pipelines:
     """
     method to insert values to the events table
     :param session: database session
     :param target: target
     :param name: name
     :param content: content
+    :param target_hash: `calc_hash` of the target, if the caller already has it
     :return: models.Pipelines
     """
     try:
-        new_pipeline = Pipelines(hash=calc_hash(target), name=name, content=content)
-        session.merge(new_pipeline)
+        new_pipeline = Pipelines(hash=target_hash or calc_hash(target), name=name, content=content)
+        _insert_new(
+            session, Pipelines, [dict(hash=new_pipeline.hash, name=new_pipeline.name, content=new_pipeline.content)]
+        )
         session.commit()
 
         return new_pipeline
@@ -170,25 +392,64 @@ def insert_context(session, run_id: str, algorithm: str, parameters: str) -> Con
         :return: models.Contexts
         """
     try:
-        new_context = Contexts(run_id=run_id, algorithm=algorithm, parameters=parameters)
-        session.add(new_context)
+        values = dict(run_id=run_id, algorithm=algorithm, parameters=parameters)
+        # a single INSERT, the new id comes back with it (RETURNING on PostgreSQL) without an ORM flush
+        result = session.execute(sqlalchemy.insert(Contexts).values(**values))
         session.commit()
+        new_context = Contexts(id=result.inserted_primary_key[0], **values)
 
         return new_context
     except sqlalchemy.exc.SQLAlchemyError as err:
         logging.error(err)
         session.rollback()
-        exit(-1)
+        raise
 
 
 def emit_ddl(session) -> None:
     """
-    emits the db schema created inside sqlalchemy metadata, to the database
+    emits the db schema created inside sqlalchemy metadata, to the database. The tables are only created by the first
+    call of the process, later calls only emit the views which have been added to the metadata since.
     :param session: database session
     :return: None
     """
+    global _tables_created
     engine = session.get_bind()
-    Base.metadata.create_all(engine)
+    with _ddl_lock:
+        # the views are `after_create` listeners of the metadata, `create_all` would create every view again
+        pending = [ddl for ddl in Base.metadata.dispatch.after_create if id(ddl) not in _emitted_ddl]
+        if not _tables_created:
+            Base.metadata.create_all(engine)
+            _tables_created = True
+        elif pending:
+            with engine.begin() as connection:
+                for ddl in pending:
+                    ddl(Base.metadata, connection)
+        _emitted_ddl.update(id(ddl) for ddl in pending)
+
+
+def _sort_layers(nodes: Dict[str, Any], dependencies: Dict[str, Set[str]]) -> List[str]:
+    """
+    memoized `layers_services.sort_layers`. The order of the layers only depends on the layer of every node and on the
+    dependencies between the nodes, so the same graph is only sorted once.
+    :param nodes: kedro-viz graph nodes by id
+    :param dependencies: ids of the nodes depending on each node
+    :return: sorted layers
+    """
+    key = (
+        frozenset((node_id, getattr(node, "layer", None)) for node_id, node in nodes.items()),
+        frozenset((node_id, frozenset(children)) for node_id, children in dependencies.items()),
+    )
+    with _layers_cache_lock:
+        if key in _layers_cache:
+            _layers_cache.move_to_end(key)
+            return list(_layers_cache[key])
+
+    layers = layers_services.sort_layers(nodes, dependencies)
+    with _layers_cache_lock:
+        _layers_cache[key] = layers
+        if len(_layers_cache) > _LAYERS_CACHE_SIZE:
+            _layers_cache.popitem(last=False)
+    return list(layers)
 
 
 def populate_data(catalog: DataCatalog, pipelines: Dict[str, Pipeline]) -> None:
@@ -201,17 +462,122 @@ def populate_data(catalog: DataCatalog, pipelines: Dict[str, Pipeline]) -> None:
     data_access_manager.add_catalog(catalog)
     data_access_manager.add_pipelines(pipelines)
     data_access_manager.set_layers(
-        layers_services.sort_layers(
+        _sort_layers(
             data_access_manager.nodes.as_dict(),
             data_access_manager.node_dependencies,
         )
     )
 
 
+@lru_cache(maxsize=1)
+def _build_engine() -> sqlalchemy.engine.Engine:
+    """
+    Creates the engine just once, on first use, with the connection string from the kedro project credentials.
+    :return: sqlalchemy.engine.Engine
+    """
+    conf_loader = ConfigLoader(["conf/base"])
+    # Connects to in-memory sqlite db if catalog configuration file cannot be accessed
+    conn_str = "sqlite://"
+    try:
+        conf_cred = conf_loader.get("credentials*")
+        conn_str = conf_cred["postgres"]["con"]
+    except ValueError as err:
+        logging.error(err)
+
+    url = sqlalchemy.engine.make_url(conn_str)
+    engine_args: Dict[str, Any] = {}
+    if url.get_backend_name() == "postgresql":
+        engine_args = dict(
+            # enough pooled connections for the parallel COPY workers of the outlier score dataset
+            pool_size=8,
+            # long kedro sessions outlive idle connections dropped by the server or a firewall
+            pool_pre_ping=True,
+            pool_recycle=3600,
+        )
+    if url.get_driver_name() == "psycopg2":
+        # executemany (e.g. bulk inserts of the events) sends multi-row VALUES pages instead of one per statement. Only
+        # the psycopg2 dialect accepts these arguments, other drivers (e.g. pg8000) keep their defaults.
+        engine_args.update(executemany_mode="values_plus_batch", executemany_values_page_size=1000)
+    engine = sqlalchemy.create_engine(conn_str, future=True, **engine_args)
+    _create_tables(engine)
+    _Session.configure(bind=engine)
+    return engine
+
+
+def _create_tables(engine: sqlalchemy.engine.Engine) -> None:
+    """
+    creates the missing tables of the models before the first row is written, so the rows of the first run on a fresh
+    database are not lost. The tables are created one by one, `Base.metadata.create_all` would also emit the views
+    registered so far, which is left to `emit_ddl`. Tables with foreign keys to tables which are not declared yet
+    (e.g. `outlier_score` before the project's `samples` model is imported) are left to `emit_ddl` as well.
+    :param engine: engine of the plugin
+    :return: None
+    """
+    tables = [table for table in Base.metadata.tables.values() if _foreign_keys_resolvable(table)]
+    for table in sqlalchemy.schema.sort_tables(tables):
+        # a transaction per table, so a table that cannot be created does not keep the others from being created
+        try:
+            with engine.begin() as connection:
+                table.create(connection, checkfirst=True)
+        except sqlalchemy.exc.SQLAlchemyError as err:
+            logging.error(err)
+
+
+def _foreign_keys_resolvable(table: sqlalchemy.Table) -> bool:
+    """
+    checks whether the tables referenced by the foreign keys of a table are declared in its metadata
+    :param table: table to check
+    :return: whether all of its foreign keys can be resolved
+    """
+    try:
+        for foreign_key in table.foreign_keys:
+            # resolving the referenced column raises if its table is not declared
+            foreign_key.column
+    except sqlalchemy.exc.NoReferencedTableError:
+        return False
+    return True
+
+
+def get_engine() -> sqlalchemy.engine.Engine:
+    """
+    Returns the sqlalchemy engine of the plugin, reading the kedro project credentials on the first call.
+    If the credentials configuration does not exist, the engine connects to an in memory empty sqlite database instead
+    :return: sqlalchemy.engine.Engine
+    """
+    with _engine_lock:
+        return _build_engine()
+
+
 def get_session() -> Session:
     """
     Creates an sqlalchemy session using the connection string from the kedro project catalog configuration.
-    If the catalog configuration does not exist, it creates a session with an in memory empty sqlite database instead
+    If the catalog configuration does not exist, it creates a session with an in memory empty sqlite database instead.
+    The session is created once per thread and reused, closing it only releases its connection.
     :return: sqlalchemy.orm.Session
     """
-    return Session(Engine)
+    get_engine()
+    return _Session()
+
+
+# engines inherited from the parent process. A forked child keeps them referenced without using them, closing their
+# pooled connections from the child would close the parent's connections to the server as well.
+_parent_engines: List[sqlalchemy.engine.Engine] = []
+
+
+def _reset_after_fork() -> None:
+    """
+    Lets a forked worker process (e.g. of the ParallelRunner) build its own engine and sessions instead of sharing the
+    connections of the parent. The locks are replaced, as the fork may have happened while another thread held them.
+    :return: None
+    """
+    global _engine_lock, _ddl_lock, _layers_cache_lock
+    _engine_lock = Lock()
+    _ddl_lock = Lock()
+    _layers_cache_lock = Lock()
+    if _build_engine.cache_info().currsize:
+        _parent_engines.append(_build_engine())
+        _build_engine.cache_clear()
+    _Session.registry.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -23,13 +23,15 @@ Generic Database Views
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #  SOFTWARE.
 
-import json
 from .models import Base, OutlierScore, Contexts
 from sqlalchemy_utils import create_materialized_view
 from sqlalchemy import Table, select
-from datetime import datetime
+from sqlalchemy.sql import Select
+import time
+from itertools import count
 from .plugin import hooks
 from enum import Enum
+from functools import lru_cache
 
 
 class ADAlgorithms(Enum):
@@ -38,15 +40,26 @@ class ADAlgorithms(Enum):
     LocalOutlierFactor = "Local Outlier Factor"
 
 
-def create_samples_os_view(algo: ADAlgorithms, params: dict):
+_view_counter = count()
+
+
+@lru_cache(maxsize=64)
+def _samples_os_select(algo: ADAlgorithms, run_id: str, parameters: str) -> Select:
     samples: Table = Base.metadata.tables.get("samples")
-    samples_os = select(samples, Contexts.run_id, Contexts.algorithm, Contexts.parameters, OutlierScore)\
+    return select(samples, Contexts.run_id, Contexts.algorithm, Contexts.parameters, OutlierScore)\
         .join(OutlierScore, samples.c.id == OutlierScore.sample_id)\
         .join(Contexts, OutlierScore.context_id == Contexts.id)\
         .where(
-            Contexts.run_id == str(hooks.trace_id),
+            Contexts.run_id == run_id,
             Contexts.algorithm == algo.value,
-            Contexts.parameters == json.dumps(params),
+            Contexts.parameters == parameters,
         )
-    current_timestamp: str = str(datetime.now().timestamp())
-    create_materialized_view(current_timestamp, samples_os, Base.metadata)
+
+
+def create_samples_os_view(algo: ADAlgorithms, parameters: str):
+    # the same algorithm and parameters within a run select the same rows, the construct is built only once for them
+    samples_os = _samples_os_select(algo, hooks.run_id, parameters)
+    # wall clock rather than monotonic time, the views outlive the process and the machine's uptime. The counter keeps
+    # views created within the resolution of the clock apart.
+    view_name: str = f"samples_os_{time.time_ns():x}_{next(_view_counter)}"
+    create_materialized_view(view_name, samples_os, Base.metadata)